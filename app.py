@@ -1,27 +1,34 @@
 from __future__ import annotations
 
 import argparse
-import re
 import sys
+from functools import lru_cache
 from io import BytesIO
 from pathlib import Path
 from typing import Optional
 import segno
-from PIL import Image, ImageOps, ImageDraw, ImageColor
+from PIL import Image, ImageOps, ImageColor
 
 # ---------------------------------------------------------------------------
 # Utility colori
 # ---------------------------------------------------------------------------
 
-_HEX_RE = re.compile(r"^[0-9a-fA-F]{3}$|^[0-9a-fA-F]{6}$")
+# Modi Pillow senza informazione di colore (logo componibile in "LA")
+GRAY_MODES = {"1", "L", "LA", "La"}
 
+_HEX_DIGITS = frozenset("0123456789abcdefABCDEF")
 
+
+@lru_cache(maxsize=256)
 def normalize_color(col: str) -> Optional[str]:
     """Normalizza il colore in un formato accettato da Pillow/Segno.
 
     - Permette nomi CSS standard (via ``ImageColor.getrgb``)
     - Gestisce stringhe esadecimali con o senza «#» (3 o 6 cifre)
     - Accetta "transparent"/"none" (restituisce "transparent")
+
+    Il risultato è in cache: usando la funzione in un ciclo (es. molti QR con
+    gli stessi colori) ogni stringa viene analizzata una volta sola.
     """
     col = col.strip()
     if not col:
@@ -31,10 +38,10 @@ def normalize_color(col: str) -> Optional[str]:
     if low in {"transparent", "none"}:  # sfondo trasparente
         return None
 
-    if _HEX_RE.match(col):
-        return f"#{col.lower()}"
-    if col.startswith("#") and _HEX_RE.match(col[1:]):
-        return f"#{col[1:].lower()}"
+    # Esadecimale a 3 o 6 cifre: controllo diretto su lunghezza e caratteri
+    hex_part = col[1:] if col.startswith("#") else col
+    if len(hex_part) in (3, 6) and _HEX_DIGITS.issuperset(hex_part):
+        return f"#{hex_part.lower()}"
 
     try:
         ImageColor.getrgb(col)
@@ -43,6 +50,21 @@ def normalize_color(col: str) -> Optional[str]:
         raise argparse.ArgumentTypeError(f"Colore non valido: {col}") from exc
 
 
+def to_color(col: Optional[str], mode: str = "RGBA") -> tuple[int, ...]:
+    """Converte un colore normalizzato in tupla per `mode` (None → trasparente)."""
+    if col is None:
+        return (0,) * len(mode)
+    return ImageColor.getcolor(col, mode)
+
+
+def is_gray(col: Optional[str]) -> bool:
+    """``True`` se il colore è un grigio (R = G = B) o trasparente."""
+    if col is None:
+        return True
+    r, g, b = ImageColor.getrgb(col)[:3]
+    return r == g == b
+
+
 # ---------------------------------------------------------------------------
 # Utility path/output
 # ---------------------------------------------------------------------------
@@ -80,10 +102,73 @@ def ensure_path_with_suffix(p: str, suffix: str, default_stem: str = "qr_logo")
 # ---------------------------------------------------------------------------
 
 
+def render_qr(
+    qr: segno.QRCode,
+    *,
+    scale: int = 10,
+    dark: Optional[str] = "#000000",
+    light: Optional[str] = "white",
+    mode: str = "RGBA",
+) -> Image.Image:
+    """Rasterizza i moduli del QR direttamente in un'immagine ``mode``.
+
+    Evita il passaggio PNG in memoria (codifica Segno + decodifica Pillow): la
+    matrice a scala 1 diventa una maschera, ingrandita con ``NEAREST`` e usata
+    per colorare i moduli scuri sopra lo sfondo. Con colori grigi si può usare
+    ``mode="LA"`` (2 byte/pixel invece di 4).
+    """
+    size = qr.symbol_size(scale=1)
+    data = bytes(255 if m else 0 for row in qr.matrix_iter(scale=1) for m in row)
+    mask = Image.frombytes("L", size, data)
+    if scale > 1:
+        mask = mask.resize((size[0] * scale, size[1] * scale), Image.Resampling.NEAREST)
+    img = Image.new(mode, mask.size, to_color(light, mode))
+    img.paste(to_color(dark, mode), mask=mask)
+    return img
+
+
+def compose_logo(
+    qr: segno.QRCode,
+    logo_file: Path,
+    *,
+    scale: int = 10,
+    dark: Optional[str] = "#000000",
+    light: Optional[str] = "white",
+    logo_scale: float = 0.25,
+    logo_border: int = 10,
+) -> Image.Image:
+    """Rasterizza il QR e vi incolla al centro il logo (con bordo opzionale)."""
+    # Se QR e logo sono in scala di grigi basta "LA": metà dei byte di RGBA
+    # in composizione e nella codifica PNG
+    with Image.open(logo_file) as src:
+        gray = src.mode in GRAY_MODES and is_gray(dark) and is_gray(light)
+        mode = "LA" if gray else "RGBA"
+        logo = src.convert(mode)
+
+    qr_img = render_qr(qr, scale=scale, dark=dark, light=light, mode=mode)
+
+    target_size = int(qr_img.size[0] * logo_scale)
+    logo.thumbnail((target_size, target_size), Image.Resampling.LANCZOS)
+
+    if logo_border > 0:
+        logo = ImageOps.expand(logo, border=logo_border, fill=to_color(light, mode))
+
+    pos = (
+        (qr_img.size[0] - logo.size[0]) // 2,
+        (qr_img.size[1] - logo.size[1]) // 2,
+    )
+
+    # Pulisce l'area del logo (estremi inclusi) riempiendo direttamente il box
+    box = (pos[0], pos[1], pos[0] + logo.size[0] + 1, pos[1] + logo.size[1] + 1)
+    qr_img.paste(to_color(light, mode), box)
+    qr_img.paste(logo, pos, mask=logo)
+    return qr_img
+
+
 def generate_qr(
     url: str,
     logo_path: str | None,
-    out_png: str,
+    out_png: Optional[str],
     out_svg: Optional[str],
     *,
     scale: int = 10,
@@ -91,58 +176,76 @@ def generate_qr(
     light: Optional[str] = "white",
     logo_scale: float = 0.25,
     logo_border: int = 10,
+    png_compress_level: int = 1,
+    png_optimize: bool = False,
 ) -> None:
-    """Crea un QR code con eventuale logo inserito."""
+    """Crea un QR code con eventuale logo inserito.
+
+    ``png_compress_level`` (0-9) è il livello zlib del PNG: i QR si comprimono
+    molto bene, quindi un livello basso costa poco in dimensione e molto meno in
+    tempo. ``png_optimize`` attiva la ricerca dei filtri di Pillow (più lenta):
+    senza logo il PNG di Segno viene quindi ricodificato da Pillow.
+
+    Con ``out_png=None`` viene scritto solo l'SVG, senza alcuna elaborazione
+    raster (il logo riguarda solo il PNG: viene verificato ma non usato).
+    """
     qr = segno.make(url, error="h")
 
-    buf = BytesIO()
-    qr.save(buf, kind="png", scale=scale, dark=dark, light=light)
-    buf.seek(0)
-    qr_img = Image.open(buf).convert("RGBA")
-
-    if light is None:
-        datas = qr_img.getdata()
-        new_data = []
-        dark_rgb = ImageColor.getrgb(dark or "#000")
-        for pixel in datas:
-            if pixel[:3] == dark_rgb:
-                new_data.append(pixel)
-            else:
-                new_data.append((0, 0, 0, 0))
-        qr_img.putdata(new_data)
-
-    if logo_path:
-        logo_file = Path(logo_path)
-        if not logo_file.is_file():
-            raise FileNotFoundError(f"Logo non trovato: {logo_file}")
-
-        logo = Image.open(logo_file).convert("RGBA")
-        target_size = int(qr_img.size[0] * logo_scale)
-        logo.thumbnail((target_size, target_size), Image.Resampling.LANCZOS)
-
-        if logo_border > 0:
-            border_fill = (0, 0, 0, 0) if light is None else light
-            logo = ImageOps.expand(logo, border=logo_border, fill=border_fill)
-
-        pos = (
-            (qr_img.size[0] - logo.size[0]) // 2,
-            (qr_img.size[1] - logo.size[1]) // 2,
+    logo_file = Path(logo_path) if logo_path else None
+    if logo_file is not None and not logo_file.is_file():
+        raise FileNotFoundError(f"Logo non trovato: {logo_file}")
+
+    # La composizione con il logo avviene tutta in memoria prima di creare
+    # cartelle o scrivere file: un logo illeggibile o parametri errati non
+    # lasciano output parziali
+    qr_img = None
+    if out_png is not None and logo_file is not None:
+        qr_img = compose_logo(
+            qr,
+            logo_file,
+            scale=scale,
+            dark=dark,
+            light=light,
+            logo_scale=logo_scale,
+            logo_border=logo_border,
         )
 
-        draw = ImageDraw.Draw(qr_img)
-        rect = [pos[0], pos[1], pos[0] + logo.size[0], pos[1] + logo.size[1]]
-        bg_fill = (0, 0, 0, 0) if light is None else light
-        draw.rectangle(rect, fill=bg_fill)
-        qr_img.paste(logo, pos, mask=logo)
-
-    Path(out_png).parent.mkdir(parents=True, exist_ok=True)
+    # L'SVG è testo e non dipende dal logo: lo scriviamo una volta sola
     if out_svg:
         Path(out_svg).parent.mkdir(parents=True, exist_ok=True)
-
-    qr_img.save(out_png, format="PNG")
-    if out_svg:
         qr.save(out_svg, scale=scale, dark=dark, light=light)
 
+    if out_png is None:
+        return
+
+    Path(out_png).parent.mkdir(parents=True, exist_ok=True)
+
+    if qr_img is not None:
+        qr_img.save(
+            out_png,
+            format="PNG",
+            compress_level=png_compress_level,
+            optimize=png_optimize,
+        )
+    elif png_optimize:
+        # Segno non cerca i filtri ottimali: ricodifichiamo il suo PNG con Pillow
+        buf = BytesIO()
+        qr.save(buf, kind="png", scale=scale, dark=dark, light=light)
+        buf.seek(0)
+        with Image.open(buf) as im:
+            im.save(out_png, format="PNG", optimize=True)
+    else:
+        # Senza logo il PNG di Segno è già quello finale: scrive un PNG a palette
+        # (1 byte/pixel o meno) con la trasparenza nel chunk tRNS, senza RGBA
+        qr.save(
+            out_png,
+            kind="png",
+            scale=scale,
+            dark=dark,
+            light=light,
+            compresslevel=png_compress_level,
+        )
+
 
 # ---------------------------------------------------------------------------
 # CLI
@@ -186,6 +289,11 @@ def main() -> None:
         help="File PNG di output.",
     )
     parser.add_argument("--out-svg", default=None, help="File SVG di output.")
+    parser.add_argument(
+        "--no-png",
+        action="store_true",
+        help="Genera solo l'SVG (se --out-svg manca, usa il nome di --out-png).",
+    )
     parser.add_argument("--scale", type=int, default=10, help="Scala del QR (1-40).")
     parser.add_argument(
         "--logo-scale",
@@ -199,11 +307,26 @@ def main() -> None:
         default=10,
         help="Spessore del bordo intorno al logo (pixel).",
     )
+    parser.add_argument(
+        "--png-level",
+        type=int,
+        default=1,
+        choices=range(10),
+        metavar="0-9",
+        help="Livello di compressione zlib del PNG (0-9).",
+    )
+    parser.add_argument(
+        "--png-optimize",
+        action="store_true",
+        help="Ricerca dei filtri PNG ottimali (file più piccolo, più lento).",
+    )
 
     args = parser.parse_args()
 
     # Normalizza i path di output: aggiungi .png/.svg se mancanti, accetta cartelle
-    out_png = ensure_path_with_suffix(args.out_png, ".png", default_stem="qr_logo")
+    out_png: Optional[str] = ensure_path_with_suffix(
+        args.out_png, ".png", default_stem="qr_logo"
+    )
     out_svg = (
         ensure_path_with_suffix(
             args.out_svg, ".svg", default_stem=Path(out_png).with_suffix("").name
@@ -211,6 +334,11 @@ def main() -> None:
         if args.out_svg
         else None
     )
+    if args.no_png:
+        if args.logo:
+            parser.error("--no-png non è compatibile con --logo (logo solo nel PNG)")
+        out_svg = out_svg or str(Path(out_png).with_suffix(".svg"))
+        out_png = None
 
     # Converti logo vuoto in None
     logo_path = None if args.logo == "" else args.logo
@@ -226,8 +354,10 @@ def main() -> None:
             light=args.light,
             logo_scale=args.logo_scale,
             logo_border=args.logo_border,
+            png_compress_level=args.png_level,
+            png_optimize=args.png_optimize,
         )
-        created = [out_png] + ([out_svg] if out_svg else [])
+        created = [p for p in (out_png, out_svg) if p]
         print("QR generato con successo! → " + " | ".join(created))
     except Exception as exc:  # pragma: no cover
         print("Errore durante la generazione del QR:", exc, file=sys.stderr)
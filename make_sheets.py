@@ -1,9 +1,25 @@
 #!/usr/bin/env python3
 from __future__ import annotations
-import argparse, math
+import argparse
+import hashlib
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial
+from itertools import islice
 from pathlib import Path
-from typing import Tuple, List
-from PIL import Image, ImageDraw, ImageOps
+from typing import Dict, Iterable, Iterator, Tuple, List, Optional, Sequence
+from PIL import Image
+
+try:
+    from itertools import batched
+except ImportError:  # Python < 3.12
+
+    def batched(iterable: Iterable, n: int) -> Iterator[tuple]:
+        it = iter(iterable)
+        while chunk := tuple(islice(it, n)):
+            yield chunk
+
 
 # ---------------------------------------------
 # Misure carta (mm)
@@ -15,6 +31,17 @@ PAPER_SIZES_MM = {
     "LETTER": (216, 279),
 }
 
+# Thread per pagina che decodificano in anticipo i PNG dei QR
+PREFETCH_THREADS = 4
+
+# Filtri di ridimensionamento per i QR ("auto": NEAREST se il rapporto è intero,
+# altrimenti BILINEAR; i QR sono binari e Lanczos aggiunge solo aloni)
+RESAMPLERS = {
+    "nearest": Image.Resampling.NEAREST,
+    "bilinear": Image.Resampling.BILINEAR,
+    "lanczos": Image.Resampling.LANCZOS,
+}
+
 
 def mm_to_px(mm: float, dpi: int) -> int:
     return int(round(mm * dpi / 25.4))
@@ -32,6 +59,26 @@ def load_pngs(folder: Path) -> List[Path]:
     return files
 
 
+def dedupe_by_content(files: Sequence[Path]) -> List[Path]:
+    """Sostituisce ogni file con il primo percorso dal contenuto identico.
+
+    Così i duplicati (es. un foglio di adesivi tutti uguali) condividono la voce
+    in cache di :func:`load_qr` e vengono decodificati e ridimensionati una volta.
+    """
+    # Solo i file con la stessa dimensione possono coincidere: leggiamo e
+    # calcoliamo l'hash soltanto per quelli, non per l'intero input
+    sizes = [f.stat().st_size for f in files]
+    counts = Counter(sizes)
+    seen: Dict[bytes, Path] = {}
+    out: List[Path] = []
+    for f, size in zip(files, sizes):
+        if counts[size] > 1:
+            digest = hashlib.blake2b(f.read_bytes(), digest_size=16).digest()
+            f = seen.setdefault(digest, f)
+        out.append(f)
+    return out
+
+
 def place_grid(
     canvas_size: Tuple[int, int],
     cols: int,
@@ -56,30 +103,80 @@ def place_grid(
     return boxes
 
 
+def pick_resampler(
+    src_size: Tuple[int, int], size: Tuple[int, int]
+) -> Image.Resampling:
+    """NEAREST se ogni lato scala di un fattore intero, altrimenti BILINEAR."""
+    integer = all(a % b == 0 or b % a == 0 for a, b in zip(src_size, size))
+    return Image.Resampling.NEAREST if integer else Image.Resampling.BILINEAR
+
+
+def contain_square(src: Image.Image, side: int, resample: str = "auto") -> Image.Image:
+    """Come ``ImageOps.contain(src, (side, side), ...)`` ma più veloce sulle
+    riduzioni forti: ``reducing_gap`` fa prima un ``reduce()`` intero (media a
+    box) fino a ~2× la misura finale e applica il filtro solo sull'ultimo tratto."""
+    w, h = src.size
+    if w > h:
+        size = (side, max(1, round(h * side / w)))
+    elif h > w:
+        size = (max(1, round(w * side / h)), side)
+    else:
+        size = (side, side)
+    if size == src.size:
+        return src
+    if resample == "auto":
+        resampler = pick_resampler(src.size, size)
+    else:
+        resampler = RESAMPLERS[resample]
+    return src.resize(size, resampler, reducing_gap=2.0)
+
+
+@lru_cache(maxsize=64)
+def _load_qr_cached(path: Path, mtime_ns: int, side: int, resample: str) -> Image.Image:
+    with Image.open(path) as im:
+        src = im.convert("RGBA")
+    # QR senza trasparenza: li teniamo in RGB, così in pagina basta una copia
+    if src.getchannel("A").getextrema()[0] == 255:
+        src = src.convert("RGB")
+    return contain_square(src, side, resample)
+
+
+def load_qr(path: Path, side: int, resample: str = "auto") -> Image.Image:
+    """Decodifica il PNG e lo adatta a una cella di lato ``side``.
+
+    Il risultato è in cache (chiave: percorso, data di modifica, lato, filtro),
+    quindi lo stesso QR usato più volte viene decodificato e ridimensionato una
+    volta sola. L'immagine restituita è condivisa: non va modificata. È RGB se
+    il QR è completamente opaco, altrimenti RGBA.
+    """
+    return _load_qr_cached(path, path.stat().st_mtime_ns, side, resample)
+
+
 def paste_center_square(
     dst: Image.Image,
     src: Image.Image,
     box: Tuple[int, int, int, int],
-    bg=(255, 255, 255, 0),
+    resample: str = "auto",
 ):
     """Ridimensiona src per contenere nel quadrato 'box' e la incolla centrata."""
     l, t, r, b = box
     side = r - l
-    # Convertiamo in RGBA per preservare eventuale trasparenza
-    src = src.convert("RGBA")
+    # Convertiamo in RGBA per preservare eventuale trasparenza (RGB = opaco)
+    if src.mode not in ("RGB", "RGBA"):
+        src = src.convert("RGBA")
     # Ridimensiona mantenendo proporzioni dentro il quadrato
-    src = ImageOps.contain(src, (side, side), Image.Resampling.LANCZOS)
+    src = contain_square(src, side, resample)
     # Calcola offset centrato
     x = l + (side - src.width) // 2
     y = t + (side - src.height) // 2
     # Se vogliamo garantire fondo bianco anche per QR trasparenti:
     if dst.mode != "RGBA":
         dst = dst.convert("RGBA")
-    # Pulisce lo sfondo nella cella (utile se vuoi “quadretti” bianchi perfetti)
-    cell_bg = Image.new("RGBA", (side, side), bg)
-    dst.alpha_composite(cell_bg, (l, t))
-    # Incolla il QR
-    dst.alpha_composite(src, (x, y))
+    # Incolla il QR: copia diretta se opaco, composizione alpha solo se serve
+    if src.mode == "RGB":
+        dst.paste(src, (x, y))
+    else:
+        dst.alpha_composite(src, (x, y))
     return dst
 
 
@@ -90,23 +187,52 @@ def draw_crop_marks(
     stroke: int = 2,
     color=(0, 0, 0, 255),
 ):
-    """Disegna crocini di taglio negli angoli a ridosso dei margini."""
+    """Disegna crocini di taglio negli angoli a ridosso dei margini.
+
+    I segmenti sono orizzontali/verticali: invece di rasterizzare linee con
+    ``ImageDraw`` riempiamo direttamente i rettangoli (stessi pixel di
+    ``line(width=stroke)``).
+    """
     W, H = img.size
-    d = ImageDraw.Draw(img)
     m = margin_px
     L = mark_len_px
-    # alto-sx
-    d.line([(m, m - L), (m, m + L)], fill=color, width=stroke)
-    d.line([(m - L, m), (m + L, m)], fill=color, width=stroke)
-    # alto-dx
-    d.line([(W - m, m - L), (W - m, m + L)], fill=color, width=stroke)
-    d.line([(W - m - L, m), (W - m + L, m)], fill=color, width=stroke)
-    # basso-sx
-    d.line([(m, H - m - L), (m, H - m + L)], fill=color, width=stroke)
-    d.line([(m - L, H - m), (m + L, H - m)], fill=color, width=stroke)
-    # basso-dx
-    d.line([(W - m, H - m - L), (W - m, H - m + L)], fill=color, width=stroke)
-    d.line([(W - m - L, H - m), (W - m + L, H - m)], fill=color, width=stroke)
+    lo = (stroke - 1) // 2
+    for cx, cy in ((m, m), (W - m, m), (m, H - m), (W - m, H - m)):
+        # tratto verticale e orizzontale centrati sull'angolo
+        img.paste(color, (cx - lo, cy - L, cx - lo + stroke, cy + L + 1))
+        img.paste(color, (cx - L, cy - lo, cx + L + 1, cy - lo + stroke))
+
+
+def render_page(
+    chunk: Sequence[Path],
+    size: Tuple[int, int],
+    boxes: Sequence[Tuple[int, int, int, int]],
+    bg,
+    resample: str = "auto",
+    crop_marks_margin: Optional[int] = None,
+) -> Image.Image:
+    """Compone una pagina con i QR di ``chunk`` nelle celle ``boxes``.
+
+    Funzione a livello di modulo (serializzabile) per poterla eseguire in un
+    processo separato. Se ``crop_marks_margin`` è valorizzato disegna i crocini.
+    """
+    page = Image.new("RGBA", size, bg)
+    side = boxes[0][2] - boxes[0][0]
+    # Decodifica/ridimensionamento in thread (Pillow rilascia il GIL) mentre il
+    # thread principale compone le celle già pronte, nell'ordine originale.
+    # Ogni percorso viene caricato una sola volta anche se ripetuto nella pagina.
+    with ThreadPoolExecutor(max_workers=PREFETCH_THREADS) as io_pool:
+        pending = {}
+        for img_path in chunk:
+            if img_path not in pending:
+                pending[img_path] = io_pool.submit(load_qr, img_path, side, resample)
+        for img_path, box in zip(chunk, boxes):
+            qr = pending[img_path].result()
+            page = paste_center_square(page, qr, box, resample=resample)
+    if crop_marks_margin is not None:
+        draw_crop_marks(page, crop_marks_margin)
+    # Convertiamo per PDF (niente alpha)
+    return page.convert("RGB")
 
 
 def make_sheets(
@@ -121,6 +247,11 @@ def make_sheets(
     background: str = "white",
     crop_marks: bool = False,
     output_png_pages: bool = False,
+    png_compress_level: int = 1,
+    png_optimize: bool = False,
+    resample: str = "auto",
+    workers: Optional[int] = None,
+    pdf_quality: int = 90,
 ):
     paper = paper.upper()
     if paper not in PAPER_SIZES_MM:
@@ -129,50 +260,77 @@ def make_sheets(
     margin_px = mm_to_px(margin_mm, dpi)
     gutter_px = mm_to_px(gutter_mm, dpi)
 
-    files = load_pngs(input_dir)
+    files = dedupe_by_content(load_pngs(input_dir))
     per_page = cols * rows
-    pages = math.ceil(len(files) / per_page)
-
-    made_images: List[Image.Image] = []
-    for p in range(pages):
-        page = Image.new(
-            "RGBA",
-            (W, H),
-            (255, 255, 255, 0) if background == "transparent" else background,
-        )
-        boxes = place_grid((W, H), cols, rows, margin_px, gutter_px)
-        chunk = files[p * per_page : (p + 1) * per_page]
-        for img_path, box in zip(chunk, boxes):
-            qr = Image.open(img_path)
-            page = paste_center_square(
-                page,
-                qr,
-                box,
-                bg=(255, 255, 255, 0) if background == "transparent" else background,
-            )
-        if crop_marks and background != "transparent":
-            draw_crop_marks(page, margin_px)
-        # Convertiamo per PDF (niente alpha)
-        made_images.append(page.convert("RGB"))
+    pages = -(-len(files) // per_page)
+
+    # Griglia e sfondo sono uguali per tutte le pagine: calcolati una volta sola.
+    # Le celle hanno lo stesso sfondo della pagina, quindi non serve ripulirle.
+    bg = (255, 255, 255, 0) if background == "transparent" else background
+    boxes = place_grid((W, H), cols, rows, margin_px, gutter_px)
+    marks = margin_px if crop_marks and background != "transparent" else None
+
+    # Le pagine sono indipendenti: con più pagine e più CPU le componiamo in
+    # parallelo. Ogni pagina (~26 MB RGB a 300 dpi) torna serializzata al
+    # processo principale, quindi il pool conviene solo con almeno 2 processi.
+    # Nota: la cache di load_qr vive nei processi del pool e si perde con esso.
+    n_workers = min(workers or os.cpu_count() or 1, pages)
+    chunks = batched(files, per_page)
+    render = partial(
+        render_page,
+        size=(W, H),
+        boxes=boxes,
+        bg=bg,
+        resample=resample,
+        crop_marks_margin=marks,
+    )
+    made_images: List[Image.Image]
+    if n_workers <= 1:
+        made_images = [render(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as ex:
+            made_images = list(ex.map(render, chunks))
 
     if output_png_pages:
         # Salva pagine singole PNG
         out_dir = out_path if out_path.suffix == "" else out_path.with_suffix("")
         out_dir.mkdir(parents=True, exist_ok=True)
         for i, im in enumerate(made_images, 1):
-            im.save(out_dir / f"sheet_{i:02d}.png", dpi=(dpi, dpi))
+            im.save(
+                out_dir / f"sheet_{i:02d}.png",
+                dpi=(dpi, dpi),
+                compress_level=png_compress_level,
+                optimize=png_optimize,
+            )
     else:
-        # Salva PDF multipagina
+        # Salva PDF multipagina (Pillow incorpora le pagine RGB come JPEG)
         out_path.parent.mkdir(parents=True, exist_ok=True)
         made_images[0].save(
             out_path,
             save_all=True,
             append_images=made_images[1:],
             resolution=dpi,
+            quality=pdf_quality,
         )
     return len(files), pages
 
 
+def positive_int(value: str) -> int:
+    """Tipo argparse: intero >= 1."""
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"Deve essere >= 1: {value}")
+    return n
+
+
+def jpeg_quality(value: str) -> int:
+    """Tipo argparse: qualità JPEG tra 1 e 95."""
+    n = int(value)
+    if not 1 <= n <= 95:
+        raise argparse.ArgumentTypeError(f"Deve essere tra 1 e 95: {value}")
+    return n
+
+
 def main():
     ap = argparse.ArgumentParser(
         description="Impagina QR in griglia per stampa (PDF multipagina)."
@@ -204,6 +362,38 @@ def main():
     ap.add_argument(
         "--png-pages", action="store_true", help="Esporta pagine PNG invece del PDF."
     )
+    ap.add_argument(
+        "--png-level",
+        type=int,
+        default=1,
+        choices=range(10),
+        metavar="0-9",
+        help="Livello di compressione zlib delle pagine PNG (0-9).",
+    )
+    ap.add_argument(
+        "--png-optimize",
+        action="store_true",
+        help="Ricerca dei filtri PNG ottimali (file più piccolo, più lento).",
+    )
+    ap.add_argument(
+        "--resample",
+        default="auto",
+        choices=["auto", *RESAMPLERS],
+        help="Filtro di ridimensionamento dei QR (auto: nearest se il rapporto "
+        "è intero, altrimenti bilinear).",
+    )
+    ap.add_argument(
+        "--workers",
+        type=positive_int,
+        default=None,
+        help="Processi per comporre le pagine in parallelo (default: n. di CPU).",
+    )
+    ap.add_argument(
+        "--pdf-quality",
+        type=jpeg_quality,
+        default=90,
+        help="Qualità JPEG (1-95) delle pagine incorporate nel PDF.",
+    )
     args = ap.parse_args()
 
     bg = "transparent" if args.transparent else "white"
@@ -221,6 +411,11 @@ def main():
         output_png_pages=(
             args.png - pages if hasattr(args, "png-pages") else args.png_pages
         ),
+        png_compress_level=args.png_level,
+        png_optimize=args.png_optimize,
+        resample=args.resample,
+        workers=args.workers,
+        pdf_quality=args.pdf_quality,
     )
     print(f"Impaginati {n_imgs} QR su {n_pages} pagina/e → {args.out}")
 